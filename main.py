@@ -3,6 +3,8 @@ import os
 import time
 import tkinter as tk
 import warnings
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tkinter import filedialog, messagebox, scrolledtext
 
 import numpy as np
@@ -15,6 +17,11 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Batches sent at once, kept small to stay within 17Track's request rate limit
+MAX_WORKERS = 3
+# 17Track statuses of packages that are left out of the dashboard
+EXCLUDED_STATUSES = frozenset(["DeliveryFailure", "NotFound", "Exception"])
+
 
 def processing(filepath=None, email=None):
     API17TRACK__KEY = os.environ.get("API17TRACK__KEY")
@@ -23,71 +30,133 @@ def processing(filepath=None, email=None):
     logging.info("Welcome to our shopify export tracking dashboard!!")
 
     data = get_shopify_export()
-    tracking_numbers = data["tracking_number"].tolist()
-    tracking_numbers = list(set(tracking_numbers))
+    tracking_numbers = data["tracking_number"].drop_duplicates().tolist()
     print(f"Found {len(tracking_numbers)} unique tracking numbers.")
 
-    df_country = pd.read_csv("data/country-codes.csv")
-    country_mappinp = dict(zip(df_country["alpha-2"], df_country["country"]))
-    del df_country
-
     print("Retrieving tracking data from 17track.net...")
-    # Initialize counters
-    registered_count = 0
-    skipped_count = 0
-    quota_exceeded_count = 0
-    output = []
-    for number in tracking_numbers[:400]:
-        logging.debug(f"Retrieving data for {number}...")
-        track = API17Track(API_KEY=API17TRACK__KEY)
+    track = API17Track(API_KEY=API17TRACK__KEY)
+
+    def fetch_batch(numbers):
+        """Retrieve a batch of packages from 17Track, registering the unknown ones.
+
+        Runs inside a worker thread, using that thread's API17Track session.
+        Returns the (row, events) order data of the retrieved packages, and a
+        Counter of the batch outcomes that the main thread adds up. A failed
+        request skips its packages instead of aborting the other batches.
+        """
+        logging.debug(f"Retrieving data for {len(numbers)} package(s)...")
         try:
-            track.retrieve_package_data(number)
-        except Exception as e:
+            packages, rejected = track.retrieve_batch(numbers)
+        except REQUEST_ERRORS as e:
+            logging.warning(
+                f"Retrieving {len(numbers)} package(s) failed with {e}. Skipping them."
+            )
+            return [], Counter(request_failed=len(numbers), skipped=len(numbers))
+
+        skipped = [
+            item
+            for item in rejected
+            if item["error"]["code"] != track.TRACKING_NEED_REGISTER
+        ]
+        to_register = [
+            item["number"]
+            for item in rejected
+            if item["error"]["code"] == track.TRACKING_NEED_REGISTER
+        ]
+        registered = []
+        failed = 0
+        if to_register:
+            logging.debug(
+                f"{len(to_register)} package(s) not registered. Registering & Retrieving now..."
+            )
+            pending = to_register
             try:
-                logging.debug(
-                    f"{number} not registered. Registering & Retrieving now..."
-                )
-                track.register_package(number)
-                registered_count += 1
-            except API17TrackError as retry_e:
-                logging.debug(
-                    f"Retry failed for {number} with {retry_e}. Skipping to next."
+                registered, register_rejected = track.register_batch(to_register)
+                # Already registered numbers can be retrieved all the same
+                pending = [item["number"] for item in registered] + [
+                    item["number"]
+                    for item in register_rejected
+                    if item["error"]["code"] == track.TRACKING_REGISTERED
+                ]
+                skipped += [
+                    item
+                    for item in register_rejected
+                    if item["error"]["code"] != track.TRACKING_REGISTERED
+                ]
+                if pending:
+                    retrieved, retrieve_rejected = track.retrieve_batch(pending)
+                    packages += retrieved
+                    skipped += retrieve_rejected
+            except REQUEST_ERRORS as e:
+                logging.warning(
+                    f"Registering & Retrieving {len(pending)} package(s) failed with {e}. Skipping them."
                 )
-                if retry_e.code.code == track.QUOTA_LIMIT:
-                    quota_exceeded_count += 1
-                skipped_count += 1
-                continue
+                failed = len(pending)
+
+        for item in skipped:
+            logging.debug(
+                f"Retry failed for {item['number']} with {item['error']['message']}. Skipping to next."
+            )
+
+        stats = Counter(
+            registered=len(registered),
+            quota_exceeded=sum(
+                item["error"]["code"] == track.QUOTA_LIMIT for item in skipped
+            ),
+            request_failed=failed,
+            skipped=len(skipped) + failed,
+        )
+
+        return packages, stats
+
+    # 17Track accepts several numbers per request, so send them in batches
+    tracking_numbers = tracking_numbers[:400]
+    batches = [
+        tracking_numbers[i : i + API17Track.BATCH_SIZE]
+        for i in range(0, len(tracking_numbers), API17Track.BATCH_SIZE)
+    ]
 
-        output.append(track.data)
+    # Collected column-wise, the sparse events are kept apart
+    output = defaultdict(list)
+    events = []
+    stats = Counter()
+    # The retrieval is network bound, so overlap the requests in a thread pool
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(MAX_WORKERS, len(batches)))
+    ) as executor:
+        futures = [executor.submit(fetch_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            packages, batch_stats = future.result()
+            stats.update(batch_stats)
+            for row, package_events in packages:
+                for field, value in zip(API17Track.ORDER_FIELDS, row):
+                    output[field].append(value)
+                events.append(package_events)
 
     # Log the summary
-    logging.info(f"Registration needed for {registered_count} package(s).")
-    logging.info(f"Quota exceeded for {quota_exceeded_count} package(s).")
-    logging.info(f"Skipped {skipped_count} package(s).")
-    logging.info(f"Successfully retrieved data for {len(output)} package(s).")
+    logging.info(f"Registration needed for {stats['registered']} package(s).")
+    logging.info(f"Quota exceeded for {stats['quota_exceeded']} package(s).")
+    logging.info(f"Request failed for {stats['request_failed']} package(s).")
+    logging.info(f"Skipped {stats['skipped']} package(s).")
+    logging.info(f"Successfully retrieved data for {len(events)} package(s).")
+
+    if not events:
+        raise RuntimeError("No packages retrieved; aborting upload")
 
     print("Processing data...")
-    df = pd.DataFrame(output)
-    df.shipping_country = df.shipping_country.apply(
-        lambda x: get_country(country_mappinp, x)
+    df = pd.DataFrame(output).join(
+        pd.DataFrame(
+            events,
+            columns=["events.InTransit", "events.Delivered", "events.InfoReceived"],
+        )
     )
-    df.recipient_country = df.recipient_country.apply(
-        lambda x: get_country(country_mappinp, x)
+    # map country codes to names, keeping unknown codes as they are
+    df.shipping_country = df.shipping_country.map(COUNTRY_MAP).fillna(
+        df.shipping_country
+    )
+    df.recipient_country = df.recipient_country.map(COUNTRY_MAP).fillna(
+        df.recipient_country
     )
-    df = df[
-        [
-            "tracking_number",
-            "carrier_name",
-            "shipping_country",
-            "recipient_country",
-            "latest_status",
-            "days_after_order",
-            "days_of_transit",
-            "events.InTransit",
-            "events.Delivered",
-            "events.InfoReceived",
-        ]
-    ]
     df.rename(
         columns={
             "events.InTransit": "in_transit_at",
@@ -96,27 +165,43 @@ def processing(filepath=None, email=None):
         },
         inplace=True,
     )
+    # low cardinality columns, stored as categories to save memory
+    for column in [
+        "carrier_name",
+        "shipping_country",
+        "recipient_country",
+        "latest_status",
+    ]:
+        df[column] = df[column].astype("category")
     data = pd.merge(data, df, how="left", on="tracking_number")
 
     # remove rows with latest_status null, or having Exception NotFound DeliveryFailure
-    data = data[~data.latest_status.isnull()]
-    data = data[
-        ~data.latest_status.str.contains(
-            "|".join(["DeliveryFailure", "NotFound", "Exception"])
-        )
-    ]
+    mask = data.latest_status.notna() & ~data.latest_status.isin(EXCLUDED_STATUSES)
+    data = data.loc[mask]
 
-    data[
-        [
-            "processing_time",
-            "shipping_time",
-            "total_time",
-            "order_created_at",
-            "info_received_at",
-            "in_transit_at",
-            "delivered_at",
-        ]
-    ] = data.apply(get_shipping_metrics, axis=1, result_type="expand")
+    if data.empty:
+        raise RuntimeError("No packages left after filtering; aborting upload")
+
+    # shipping metrics, computed on whole columns at once
+    order_created_at = pd.to_datetime(
+        data["order_created_at"], dayfirst=True, errors="coerce"
+    )
+    info_received_at = pd.to_datetime(data["info_received_at"], errors="coerce")
+    in_transit_at = pd.to_datetime(data["in_transit_at"], errors="coerce")
+    delivered_at = pd.to_datetime(data["delivered_at"], errors="coerce")
+
+    data["processing_time"] = (in_transit_at - order_created_at).dt.days
+    data["shipping_time"] = (delivered_at - in_transit_at).dt.days
+    data["total_time"] = data["processing_time"] + data["shipping_time"]
+    for column, dates in [
+        ("order_created_at", order_created_at),
+        ("info_received_at", info_received_at),
+        ("in_transit_at", in_transit_at),
+        ("delivered_at", delivered_at),
+    ]:
+        data[column] = dates.dt.strftime("%Y-%m-%d").where(dates.notna(), None)
+
+    data.to_csv("data/output.csv", index=False)
 
     print("Uploading data to Google Sheets...")
     IS_UPLOAD = True
@@ -138,8 +223,6 @@ def processing(filepath=None, email=None):
             f"Upload Complete!\nSheet URL : https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit#gid=0"
         )
 
-    data.to_csv("data/output.csv", index=False)
-
     # print the dashboard url
     IS_DASHBOARD = True
     if IS_DASHBOARD:
@@ -0,0 +1,39 @@
+"""Build country_map.py from data/country-codes.csv
+
+The country codes are static, so the mapping is generated once and imported
+instead of parsing the CSV on every run. Re-run after updating the CSV:
+
+    python scripts/build_country_map.py
+"""
+
+import csv
+import json
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CSV_PATH = os.path.join(ROOT, "data", "country-codes.csv")
+OUTPUT_PATH = os.path.join(ROOT, "country_map.py")
+
+
+def build_country_map(csv_path=CSV_PATH, output_path=OUTPUT_PATH):
+    """write the alpha-2 code -> country name mapping as a python module
+
+    Args:
+        csv_path (str, optional): country codes csv. Defaults to CSV_PATH.
+        output_path (str, optional): generated module path. Defaults to OUTPUT_PATH.
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        rows = [(row["alpha-2"], row["country"]) for row in csv.DictReader(f)]
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write('"""Generated by scripts/build_country_map.py, do not edit."""\n\n')
+        f.write("COUNTRY_MAP = {\n")
+        for code, country in rows:
+            # json quoting gives the double quoted strings the repo uses
+            key, value = json.dumps(code), json.dumps(country, ensure_ascii=False)
+            f.write(f"    {key}: {value},\n")
+        f.write("}\n")
+
+
+if __name__ == "__main__":
+    build_country_map()
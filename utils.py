@@ -2,15 +2,20 @@ import pandas as pd
 import numpy as np
 import os
 import re
+import functools
+import threading
 import gspread
+from gspread.utils import rowcol_to_a1
 import json
+import logging
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from requests import get, post
-from types import SimpleNamespace
+import requests
 import tkinter as tk
 from tkinter import filedialog
 
+from country_map import COUNTRY_MAP
+
 """
     Notes:
     Since we are using a service account, the file created by it will be only accessible to that account.
@@ -27,86 +32,104 @@ class API17Track:
     TRACKING_REGISTERED = -18019901
     TRACKING_NEED_REGISTER = -18019902
     QUOTA_LIMIT = -18019908
+    BATCH_SIZE = 40  # Max tracking numbers accepted per request
+    # Order of the values in the rows built by _build_order_data
+    ORDER_FIELDS = (
+        "tracking_number",
+        "carrier_name",
+        "shipping_country",
+        "recipient_country",
+        "latest_status",
+        "days_after_order",
+        "days_of_transit",
+    )
 
     def __init__(self, API_KEY: str) -> None:
-        self.data = {}
         self.api_key = API_KEY
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        """Session of the calling thread, reused so the connections to 17Track are pooled.
+
+        requests.Session is not thread-safe, so each worker thread gets its own.
+        """
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(
+                {"content-type": "application/json", "17token": self.api_key}
+            )
+        return self._local.session
 
-    def _build_request(self, endpoint: str, payload: list):
-        response = (
-            post(
-                url=f"{self.API_BASE + endpoint}",
-                json=payload,
-                headers={"content-type": "application/json", "17token": self.api_key},
+    def _post(self, endpoint: str, payload: list):
+        response = self.session.post(url=f"{self.API_BASE + endpoint}", json=payload)
+        response.raise_for_status()
+
+        data = response.json().get("data") or {}
+        if "accepted" not in data:  # Whole request refused (bad token, payload...)
+            raise API17TrackError(
+                data.get("errors"), f"17Track {endpoint} request was not processed"
             )
-            .json(object_hook=lambda d: SimpleNamespace(**d))
-            .data
-        )  # Convert to Object and return the 'data' key
-
-        if response.accepted:
-            return response.accepted[0]
-
-        match response.rejected[0].error.code:
-            case self.TRACKING_REGISTERED | self.TRACKING_NEED_REGISTER:
-                raise Exception(response.rejected[0].error.message)  # Default Throw
-            case self.QUOTA_LIMIT | _:
-                raise API17TrackError(
-                    response.rejected[0].error, response.rejected[0].error.message
-                )
-
-    def register_package(self, tracking_number: str):
-        """Register a Tracking on 17Track"""
-
-        creation = self._build_request(
-            "register",
-            payload=[
-                {
-                    "number": tracking_number,
-                }
-            ],
-        )
 
-        return self.retrieve_package_data(
-            tracking_number
-        )  # Update the Order Data (Status, etc)
+        return data  # Return the 'data' key of the response
 
-    def retrieve_package_data(self, tracking_number: str) -> dict:
-        """Retrieve data from 17Track Tracking"""
+    def register_batch(self, tracking_numbers: list):
+        """Register up to BATCH_SIZE Trackings on 17Track in a single request
 
-        try:
-            obj_17track = self._build_request(
-                "gettrackinfo", payload=[{"number": tracking_number}]
-            )
-        except Exception as e:
-            raise Exception(e)
+        Returns:
+            tuple: (accepted, rejected) items of the 17Track response
+        """
 
-        return self._build_order_data(obj_17track)
+        response = self._post(
+            "register", payload=[{"number": number} for number in tracking_numbers]
+        )
 
-    def _build_order_data(self, obj_17track) -> dict:
-        """Build our Object(Order Document) from 17Track Data."""
+        return response["accepted"], response["rejected"]
 
-        self.data: dict = {
-            "tracking_number": obj_17track.number,
-            "carrier_name": obj_17track.track_info.tracking.providers[0].provider.name,
-            "shipping_country": obj_17track.track_info.shipping_info.shipper_address.country,
-            "recipient_country": obj_17track.track_info.shipping_info.recipient_address.country,
-            "latest_status": obj_17track.track_info.latest_status.status,
-            "days_after_order": obj_17track.track_info.time_metrics.days_after_order,
-            "days_of_transit": obj_17track.track_info.time_metrics.days_of_transit,
-        }
+    def retrieve_batch(self, tracking_numbers: list):
+        """Retrieve up to BATCH_SIZE Trackings from 17Track in a single request
 
-        if (hasattr(obj_17track.track_info.tracking.providers[0], "events")) and (
-            obj_17track.track_info.tracking.providers[0].events is not None
-        ):
-            for event in obj_17track.track_info.tracking.providers[0].events:
-                if hasattr(event, "sub_status") and hasattr(event, "time_raw"):
-                    if "_" not in event.sub_status:
-                        self.data[f"events.{event.sub_status}"] = event.time_raw.date
-                    else:
-                        sub_status = event.sub_status.split("_")[0]
-                        self.data[f"events.{sub_status}"] = event.time_raw.date
+        Returns:
+            tuple: (accepted, rejected) where accepted holds the (row, events) order data
+            and rejected the 17Track items (number, error) that could not be retrieved
+        """
 
-        return self.data
+        response = self._post(
+            "gettrackinfo", payload=[{"number": number} for number in tracking_numbers]
+        )
+
+        packages = [self._build_order_data(obj) for obj in response["accepted"]]
+        return packages, response["rejected"]
+
+    def _build_order_data(self, obj_17track) -> tuple:
+        """Build our Object(Order Document) from 17Track Data.
+
+        Returns:
+            tuple: (row, events) where row holds the ORDER_FIELDS values and events
+            maps "events.<status>" to the date the package reached it
+        """
+
+        track_info = obj_17track["track_info"]
+        provider = track_info["tracking"]["providers"][0]
+        row = (
+            obj_17track["number"],
+            provider["provider"]["name"],
+            track_info["shipping_info"]["shipper_address"]["country"],
+            track_info["shipping_info"]["recipient_address"]["country"],
+            track_info["latest_status"]["status"],
+            track_info["time_metrics"]["days_after_order"],
+            track_info["time_metrics"]["days_of_transit"],
+        )
+
+        events = {}
+        if provider.get("events") is not None:
+            for event in provider["events"]:
+                if "sub_status" in event and "time_raw" in event:
+                    # "InTransit_PickedUp" -> "InTransit", plain statuses are kept
+                    sub_status = event["sub_status"].split("_")[0]
+                    events[f"events.{sub_status}"] = event["time_raw"]["date"]
+
+        return row, events
 
 
 class API17TrackError(Exception):
@@ -115,11 +138,22 @@ class API17TrackError(Exception):
         self.code = code
 
 
+# Failures of a whole 17Track request: network/HTTP errors, non JSON bodies, refusals
+REQUEST_ERRORS = (requests.RequestException, ValueError, API17TrackError)
+
+
 # ---------- Google Sheet & Drive helpers -----------
 
 
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+
+
+@functools.lru_cache(maxsize=None)
 def get_google_drive_client(creds_path):
-    """get google drive client
+    """get google drive client, built once per credentials file
 
     Args:
         creds_path (str): service account credentials file path
@@ -128,24 +162,15 @@ def get_google_drive_client(creds_path):
         _type_: client
     """
 
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-
-    credentials = Credentials.from_service_account_file(creds_path, scopes=scopes)
+    credentials = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
     client = build("drive", "v3", credentials=credentials)
 
     return client
 
 
+@functools.lru_cache(maxsize=None)
 def get_google_client_spreadsheet(creds_path):
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-
-    credentials = Credentials.from_service_account_file(creds_path, scopes=scopes)
+    credentials = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
     client = build("sheets", "v4", credentials=credentials)
 
     return client
@@ -156,6 +181,7 @@ def create_google_spreadsheet(
     spreadsheet_name,
     folder_id="1HpDBpJ8W4f7EvLz3tGi3CWnjB0SSKgwD",
     drive_client=None,
+    sharedEmail=None,
 ):
     """Create a spreadsheet at the designated drive folder
 
@@ -164,6 +190,7 @@ def create_google_spreadsheet(
         spreadsheet_name (str): name of the spreadsheet
         folder_id (str, optional): drive folder id. Defaults to '1HpDBpJ8W4f7EvLz3tGi3CWnjB0SSKgwD'.
         drive_client (object, optional): drive client. Defaults to None.
+        sharedEmail (str | list, optional): email(s) given writer access. Defaults to None.
 
     Returns:
         _type_: _description_
@@ -174,9 +201,46 @@ def create_google_spreadsheet(
     response = spreadsheet_client.spreadsheets().create(body=spreadsheet).execute()
 
     spreadsheet_id = response["spreadsheetId"]
-    drive_client.files().update(
-        fileId=spreadsheet_id, addParents=folder_id, removeParents="root"
-    ).execute()
+
+    if isinstance(sharedEmail, str):
+        sharedEmail = [sharedEmail]
+    # Unique, as each email is the id of its request in the batch below
+    emails = list(dict.fromkeys(email for email in sharedEmail or [] if email))
+
+    # Move and share the file in a single batch request to the Drive API
+    errors = []
+
+    def on_response(request_id, response, exception):
+        if exception is None:
+            return
+        if request_id == "move":
+            errors.append(exception)
+        else:
+            # The sheet exists already, so a failed share must not abandon it
+            logging.warning(
+                f"Could not share the spreadsheet with {request_id}: {exception}"
+            )
+
+    batch = drive_client.new_batch_http_request(callback=on_response)
+    batch.add(
+        drive_client.files().update(
+            fileId=spreadsheet_id, addParents=folder_id, removeParents="root"
+        ),
+        request_id="move",
+    )
+    for email in emails:
+        # Notification left on, Drive refuses to share silently with addresses
+        # that have no Google account
+        batch.add(
+            drive_client.permissions().create(
+                fileId=spreadsheet_id,
+                body={"type": "user", "role": "writer", "emailAddress": email},
+            ),
+            request_id=email,
+        )
+    batch.execute()
+    if errors:
+        raise errors[0]
 
     return spreadsheet_id
 
@@ -198,18 +262,20 @@ def upload_dataframe_to_google_sheet(
     if not dataframe.empty:
         # We need to replace NaNs and Infs with None and "Infinity" because gsheets doesn't support them.
         df = dataframe.replace([np.inf, -np.inf], "Infinity")
-        values = [df.columns.tolist()] + df.to_numpy(na_value=None).tolist()
-        body = {"values": values}
-        request_range = f"{sheet_name}!A1:{chr(65 + df.shape[1] - 1)}{df.shape[0] + 1}"
+        values = [df.columns.tolist()] + df.astype(object).where(
+            df.notna(), None
+        ).values.tolist()
+        # rowcol_to_a1 handles columns past Z (AA, AB, ...), unlike chr(65 + n)
+        end_a1 = rowcol_to_a1(df.shape[0] + 1, df.shape[1])
+        request_range = f"{sheet_name}!A1:{end_a1}"
+        body = {
+            "valueInputOption": "RAW",
+            "data": [{"range": request_range, "values": values}],
+        }
         request = (
             client.spreadsheets()
             .values()
-            .update(
-                spreadsheetId=spreadsheet_id,
-                valueInputOption="RAW",
-                range=request_range,
-                body=body,
-            )
+            .batchUpdate(spreadsheetId=spreadsheet_id, body=body)
         )
         request.execute()
 
@@ -289,23 +355,6 @@ def get_tracking_dashboard(
 # ---------- Shopify Export Helpers -----------
 
 
-def get_country(country_mappinp: dict, country_code: str):
-    """get the country name from the country code
-
-    Args:
-        country_mappinp (dict): given dict of country code and country name
-        country_code (str): country code
-
-    Returns:
-        _type_: string
-    """
-
-    if country_code in country_mappinp.keys():
-        return country_mappinp[country_code]
-    else:
-        return country_code
-
-
 def get_shopify_export():
     """Get the shopify export file and pass it to process_file
 
@@ -323,15 +372,18 @@ def get_shopify_export():
 
 
 def process_file(file_path):
+    # Tracking numbers (6th column) are read as text, numeric ones would lose
+    # digits as floats or fail to merge with the 17Track data as ints
+    dtype = {5: str}
     if file_path.endswith(".csv"):
         try:
-            df = pd.read_csv(file_path)
+            df = pd.read_csv(file_path, dtype=dtype)
         except Exception as e:
             print(f"An error occurred: {e}")
             return None
     elif file_path.endswith(".xlsx"):
         try:
-            df = pd.read_excel(file_path)
+            df = pd.read_excel(file_path, engine="calamine", dtype=dtype)
         except Exception as e:
             print(f"An error occurred: {e}")
             return None
@@ -354,46 +406,3 @@ def process_file(file_path):
     df_main = df.dropna(axis=0, subset=["tracking_number"])
     print(f"There are {len(df)} orders with {len(df_main)} tracking numbers.")
     return df_main
-
-
-def get_shipping_metrics(df_row: pd.Series):
-    """get the shipping metrics from the dataframe row
-
-    Args:
-        df_row (pd.Series): shopify export with tracking infos
-
-    Returns:
-        _type_: tuple
-    """
-    # convert df_row string date into datetime date
-    order_created_at = pd.to_datetime(df_row["order_created_at"], dayfirst=True)
-    in_transit_at = pd.to_datetime(df_row["in_transit_at"])
-    delivered_at = pd.to_datetime(df_row["delivered_at"])
-    info_received_at = pd.to_datetime(df_row["info_received_at"])
-
-    processing_time = (in_transit_at - order_created_at).days
-    shipping_time = (delivered_at - in_transit_at).days
-    total_time = processing_time + shipping_time
-
-    order_created_at = (
-        order_created_at.strftime("%Y-%m-%d") if pd.notnull(order_created_at) else None
-    )
-    info_received_at = (
-        info_received_at.strftime("%Y-%m-%d") if pd.notnull(info_received_at) else None
-    )
-    in_transit_at = (
-        in_transit_at.strftime("%Y-%m-%d") if pd.notnull(in_transit_at) else None
-    )
-    delivered_at = (
-        delivered_at.strftime("%Y-%m-%d") if pd.notnull(delivered_at) else None
-    )
-
-    return (
-        processing_time,
-        shipping_time,
-        total_time,
-        order_created_at,
-        info_received_at,
-        in_transit_at,
-        delivered_at,
-    )